@@ -18,7 +18,9 @@ def separate_and_evaluate(
     softmask,
     output_dir,
     eval_dir,
-    device='cpu'
+    device='cpu',
+    quantize=False,
+    half=False
 ):
     estimates = test.separate(
         audio=track.audio,
@@ -27,7 +29,9 @@ def separate_and_evaluate(
         niter=niter,
         alpha=alpha,
         softmask=softmask,
-        device=device
+        device=device,
+        quantize=quantize,
+        half=half
     )
     if output_dir:
         mus.save_estimates(estimates, track, output_dir)
@@ -108,7 +112,10 @@ if __name__ == '__main__':
     args, _ = parser.parse_known_args()
     args = test.inference_args(parser, args)
 
-    use_cuda = not args.no_cuda and torch.cuda.is_available()
+    # quantized models only run on cpu
+    use_cuda = (
+        not args.no_cuda and not args.quantize and torch.cuda.is_available()
+    )
     device = torch.device("cuda" if use_cuda else "cpu")
 
     mus = musdb.DB(
@@ -131,7 +138,9 @@ if __name__ == '__main__':
                     softmask=args.softmask,
                     output_dir=args.outdir,
                     eval_dir=args.evaldir,
-                    device=device
+                    device=device,
+                    quantize=args.quantize,
+                    half=args.half
                 ),
                 iterable=mus.tracks,
                 chunksize=1
@@ -154,7 +163,9 @@ if __name__ == '__main__':
                 softmask=args.softmask,
                 output_dir=args.outdir,
                 eval_dir=args.evaldir,
-                device=device
+                device=device,
+                quantize=args.quantize,
+                half=args.half
             )
             results.add_track(scores)
 
@@ -7,7 +7,8 @@ dependencies = ['torch', 'numpy']
 
 
 def umxhq(
-    target='vocals', device='cpu', pretrained=True, *args, **kwargs
+    target='vocals', device='cpu', pretrained=True,
+    *args, progress=True, **kwargs
 ):
     """
     Open Unmix 2-channel/stereo BiLSTM Model trained on MUSDB18-HQ
@@ -18,6 +19,7 @@ def umxhq(
                         ['vocals', 'drums', 'bass', 'other']
         pretrained (bool): If True, returns a model pre-trained on MUSDB18-HQ
         device (str): selects device to be used for inference
+        progress (bool): If True, displays a progress bar of the download
     """
     # set urls for weights
     target_urls = {
@@ -49,7 +51,8 @@ def umxhq(
     if pretrained:
         state_dict = torch.hub.load_state_dict_from_url(
             target_urls[target],
-            map_location=device
+            map_location=device,
+            progress=progress
         )
         unmix.load_state_dict(state_dict)
         unmix.stft.center = True
@@ -59,7 +62,8 @@ def umxhq(
 
 
 def umx(
-    target='vocals', device='cpu', pretrained=True, *args, **kwargs
+    target='vocals', device='cpu', pretrained=True,
+    *args, progress=True, **kwargs
 ):
     """
     Open Unmix 2-channel/stereo BiLSTM Model trained on MUSDB18
@@ -70,6 +74,7 @@ def umx(
                         ['vocals', 'drums', 'bass', 'other']
         pretrained (bool): If True, returns a model pre-trained on MUSDB18-HQ
         device (str): selects device to be used for inference
+        progress (bool): If True, displays a progress bar of the download
     """
     # set urls for weights
     target_urls = {
@@ -101,7 +106,8 @@ def umx(
     if pretrained:
         state_dict = torch.hub.load_state_dict_from_url(
             target_urls[target],
-            map_location=device
+            map_location=device,
+            progress=progress
         )
         unmix.load_state_dict(state_dict)
         unmix.stft.center = True
@@ -1,9 +1,31 @@
+from collections import OrderedDict
+import math
 from torch.nn import LSTM, Linear, BatchNorm1d, Parameter
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 
+def _fold_bn(weight, bias, bn):
+    """
+    Returns weight and bias of a linear layer (with optional `bias`)
+    followed by `bn` in eval mode, `bn` can also be a `NoOp`.
+    The batch norm is folded in the dtype of `weight`.
+    """
+    if bias is None:
+        bias = weight.new_zeros(weight.shape[0])
+    if isinstance(bn, BatchNorm1d):
+        scale = bn.weight.to(weight) / torch.sqrt(
+            bn.running_var.to(weight) + bn.eps
+        )
+        weight = weight * scale[:, None]
+        bias = (
+            (bias.to(weight) - bn.running_mean.to(weight)) * scale
+            + bn.bias.to(weight)
+        )
+    return weight, bias
+
+
 class NoOp(nn.Module):
     def __init__(self):
         super().__init__()
@@ -17,16 +39,44 @@ class STFT(nn.Module):
         self,
         n_fft=4096,
         n_hop=1024,
-        center=False
+        center=False,
+        use_conv=False
     ):
         super(STFT, self).__init__()
-        self.window = nn.Parameter(
-            torch.hann_window(n_fft),
-            requires_grad=False
-        )
+        # a buffer (not a parameter) follows the module on `.to(device)`
+        # and is therefore already resident on the device of `x`
+        self.register_buffer('window', torch.hann_window(n_fft))
         self.n_fft = n_fft
         self.n_hop = n_hop
         self.center = center
+        # compute the stft as a strided `conv1d` with windowed dft kernels
+        # instead of `torch.stft`, e.g. for backends without (cu)fft support.
+        # This is a module-level option only (like `center`), e.g. set
+        # `unmix.stft.use_conv = True`, it is not exposed on the command line
+        self.use_conv = use_conv
+        # windowed dft kernels, cached for the device and dtype of the window
+        self._kernels = None
+
+    def _dft_kernels(self):
+        kernels = self._kernels
+        if (
+            kernels is None or
+            kernels.device != self.window.device or
+            kernels.dtype != self.window.dtype
+        ):
+            nb_bins = self.n_fft // 2 + 1
+            n = torch.arange(self.n_fft, device=self.window.device)
+            k = torch.arange(nb_bins, device=self.window.device)
+            # reduce k*n modulo n_fft before scaling to keep angles exact
+            angle = (k[:, None] * n[None, :]).remainder(self.n_fft).double()
+            angle *= 2 * math.pi / self.n_fft
+            window = self.window.double()
+            # (2*nb_bins, 1, n_fft) with the real kernels before the imag
+            kernels = torch.cat(
+                [torch.cos(angle) * window, -torch.sin(angle) * window]
+            ).to(self.window.dtype).unsqueeze(1)
+            self._kernels = kernels
+        return kernels
 
     def forward(self, x):
         """
@@ -34,11 +84,17 @@ class STFT(nn.Module):
         Output:(nb_samples, nb_channels, nb_bins, nb_frames, 2)
         """
 
-        nb_samples, nb_channels, nb_timesteps = x.size()
+        nb_samples = x.shape[0]
+        nb_channels = x.shape[1]
 
         # merge nb_samples and nb_channels for multichannel stft
         x = x.reshape(nb_samples*nb_channels, -1)
 
+        if self.use_conv:
+            return self._conv_stft(x).view(
+                nb_samples, nb_channels, self.n_fft // 2 + 1, -1, 2
+            )
+
         # compute stft with parameters as close as possible scipy settings
         stft_f = torch.stft(
             x,
@@ -54,6 +110,95 @@ class STFT(nn.Module):
         )
         return stft_f
 
+    def _conv_stft(self, x):
+        """
+        Input: (nb_samples*nb_channels, nb_timesteps)
+        Output:(nb_samples*nb_channels, nb_bins, nb_frames, 2)
+        """
+        x = x.unsqueeze(1)
+        if self.center:
+            # same padding as `torch.stft(..., center=True)`
+            x = F.pad(x, [self.n_fft // 2, self.n_fft // 2], mode='reflect')
+
+        stft_f = F.conv1d(x, self._dft_kernels(), stride=self.n_hop)
+
+        # split (real, imag) kernels to the last dimension
+        stft_f = stft_f.view(stft_f.shape[0], 2, -1, stft_f.shape[-1])
+        return stft_f.permute(0, 2, 3, 1).contiguous()
+
+
+class ISTFT(nn.Module):
+    def __init__(
+        self,
+        n_fft=4096,
+        n_hop=1024,
+        center=False
+    ):
+        super(ISTFT, self).__init__()
+        self.register_buffer('window', torch.hann_window(n_fft))
+        self.n_fft = n_fft
+        self.n_hop = n_hop
+        self.center = center
+        # overlap-added squared window, cached for the last frame count,
+        # device and dtype
+        self._envelope = None
+
+    def _window_envelope(self, nb_frames):
+        envelope = self._envelope
+        if (
+            envelope is None or
+            envelope.shape[-1] != self.n_fft + self.n_hop * (nb_frames - 1) or
+            envelope.device != self.window.device or
+            envelope.dtype != self.window.dtype
+        ):
+            envelope = F.fold(
+                self.window.pow(2).view(1, -1, 1).expand(-1, -1, nb_frames),
+                output_size=(1, self.n_fft + self.n_hop * (nb_frames - 1)),
+                kernel_size=(1, self.n_fft),
+                stride=(1, self.n_hop)
+            ).view(-1)
+            # skip the NOLA check of `torch.istft`/`scipy.signal.istft`:
+            # zeros only occur where the overlap-added frames are zero too
+            envelope = envelope.clamp(min=1e-11)
+            self._envelope = envelope
+        return envelope
+
+    def forward(self, X, length=None):
+        """
+        Input: (nb_samples, nb_channels, nb_bins, nb_frames, 2)
+        Output:(nb_samples, nb_channels, nb_timesteps)
+        """
+
+        shape = X.shape
+        nb_bins, nb_frames = shape[-3], shape[-2]
+
+        # merge all leading dimensions and move frames before bins
+        X = X.reshape(-1, nb_bins, nb_frames, 2).transpose(1, 2)
+
+        # inverse fft of every frame and apply the synthesis window
+        frames = torch.irfft(
+            X, signal_ndim=1, signal_sizes=(self.n_fft,)
+        ) * self.window
+
+        # overlap-add frames to (nb_samples*nb_channels, nb_timesteps)
+        nb_timesteps = self.n_fft + self.n_hop * (nb_frames - 1)
+        x = F.fold(
+            frames.transpose(1, 2),
+            output_size=(1, nb_timesteps),
+            kernel_size=(1, self.n_fft),
+            stride=(1, self.n_hop)
+        ).view(-1, nb_timesteps)
+        x = x / self._window_envelope(nb_frames)
+
+        if self.center:
+            x = x[:, self.n_fft // 2:nb_timesteps - self.n_fft // 2]
+
+        if length is not None:
+            x = x[:, :length]
+
+        # reshape back to channel dimension
+        return x.reshape(shape[:-3] + (-1,))
+
 
 class Spectrogram(nn.Module):
     def __init__(
@@ -68,20 +213,28 @@ class Spectrogram(nn.Module):
     def forward(self, stft_f):
         """
         Input: complex STFT
-            (nb_samples, nb_bins, nb_frames, 2)
+            (nb_samples, nb_channels, nb_bins, nb_frames, 2)
         Output: Power/Mag Spectrogram
             (nb_frames, nb_samples, nb_channels, nb_bins)
         """
-        stft_f = stft_f.transpose(2, 3)
+        # move frames to the front before reducing the (real, imag)
+        # dimension, so the magnitude is written contiguously in the
+        # (nb_frames, nb_samples, nb_channels, nb_bins) layout of the LSTM
+        stft_f = stft_f.permute(3, 0, 1, 2, 4)
         # take the magnitude
-        stft_f = stft_f.pow(2).sum(-1).pow(self.power / 2.0)
+        if self.power == 1:
+            # single reduction kernel without a squared intermediate
+            stft_f = stft_f.norm(p=2, dim=-1)
+        elif self.power == 2:
+            stft_f = stft_f.pow(2).sum(-1)
+        else:
+            stft_f = stft_f.pow(2).sum(-1).pow(self.power / 2.0)
 
         # downmix in the mag domain
         if self.mono:
-            stft_f = torch.mean(stft_f, 1, keepdim=True)
+            stft_f = torch.mean(stft_f, 2, keepdim=True)
 
-        # permute output for LSTM convenience
-        return stft_f.permute(2, 0, 1, 3)
+        return stft_f
 
 
 class OpenUnmix(nn.Module):
@@ -105,6 +258,9 @@ class OpenUnmix(nn.Module):
             or (nb_frames, nb_samples, nb_channels, nb_bins)
         Output: Power/Mag Spectrogram
                 (nb_frames, nb_samples, nb_channels, nb_bins)
+
+        Note that compiling the model with `torch.jit.script` is not
+        supported.
         """
 
         super(OpenUnmix, self).__init__()
@@ -187,21 +343,55 @@ class OpenUnmix(nn.Module):
             torch.ones(self.nb_output_bins).float()
         )
 
+    def fuse_bn(self):
+        """
+        Folds the running statistics and affine parameters of the batch
+        norm layers into the preceding linear layers. The fused model is
+        only valid for inference.
+        """
+        with torch.no_grad():
+            for fc_name, bn_name in (
+                ('fc1', 'bn1'), ('fc2', 'bn2'), ('fc3', 'bn3')
+            ):
+                fc = getattr(self, fc_name)
+                bn = getattr(self, bn_name)
+                if not isinstance(bn, BatchNorm1d):
+                    continue
+
+                weight, bias = _fold_bn(fc.weight, fc.bias, bn)
+                fc.weight = Parameter(weight)
+                fc.bias = Parameter(bias)
+                setattr(self, bn_name, NoOp())
+
     def forward(self, x):
         # check for waveform or spectrogram
         # transform to spectrogram if (nb_samples, nb_channels, nb_timesteps)
         # and reduce feature dimensions, therefore we reshape
         x = self.transform(x)
-        nb_frames, nb_samples, nb_channels, nb_bins = x.data.shape
-
-        mix = x.detach().clone()
-
-        # crop
-        x = x[..., :self.nb_bins]
+        return self._forward_from_spec(x)
 
-        # shift and scale input to mean=0 std=1 (across all bins)
-        x += self.input_mean
-        x *= self.input_scale
+    def _forward_from_spec(self, x):
+        """
+        Input: Power/Mag Spectrogram
+                (nb_frames, nb_samples, nb_channels, nb_bins)
+        """
+        # plain shape lookups instead of `.data.shape`
+        nb_frames = x.shape[0]
+        nb_samples = x.shape[1]
+        nb_channels = x.shape[2]
+
+        # keep the unmodified input as mixture, a detached view instead of
+        # a copy since the input is never modified below
+        mix = x.detach()
+
+        # crop, shift and scale input to mean=0 std=1 (across all bins)
+        # (x + mean) * scale is evaluated as x * scale + mean * scale so
+        # that it runs as a single `addcmul` pass over the spectrogram
+        x = torch.addcmul(
+            self.input_mean * self.input_scale,
+            x[..., :self.nb_bins],
+            self.input_scale
+        )
 
         # to (nb_frames*nb_samples, nb_channels*nb_bins)
         # and encode to (nb_frames*nb_samples, hidden_size)
@@ -209,8 +399,9 @@ class OpenUnmix(nn.Module):
         # normalize every instance in a batch
         x = self.bn1(x)
         x = x.reshape(nb_frames, nb_samples, self.hidden_size)
-        # squash range ot [-1, 1]
-        x = torch.tanh(x)
+        # squash range ot [-1, 1], activations are applied in place as
+        # their inputs are fresh intermediates not needed for backward
+        x = torch.tanh_(x)
 
         # apply 3-layers of stacked LSTM
         lstm_out = self.lstm(x)
@@ -222,7 +413,7 @@ class OpenUnmix(nn.Module):
         x = self.fc2(x.reshape(-1, x.shape[-1]))
         x = self.bn2(x)
 
-        x = F.relu(x)
+        x = F.relu(x, inplace=True)
 
         # second dense stage + layer norm
         x = self.fc3(x)
@@ -231,11 +422,237 @@ class OpenUnmix(nn.Module):
         # reshape back to original dim
         x = x.reshape(nb_frames, nb_samples, nb_channels, self.nb_output_bins)
 
-        # apply output scaling
-        x *= self.output_scale
-        x += self.output_mean
+        # apply output scaling in a single pass
+        x = torch.addcmul(self.output_mean, x, self.output_scale)
 
         # since our output is non-negative, we can apply RELU
-        x = F.relu(x) * mix
+        x = F.relu(x, inplace=True) * mix
 
         return x
+
+
+class Separator(nn.Module):
+    def __init__(
+        self,
+        target_models,
+        half=False
+    ):
+        """
+        Input: (nb_samples, nb_channels, nb_timesteps)
+        Output: Power/Mag Spectrograms of all targets
+                (nb_frames, nb_samples, nb_channels, nb_bins, nb_targets)
+            and the complex mixture STFT
+                (nb_samples, nb_channels, nb_bins, nb_frames, 2)
+
+        Note that with `half=True` the given target models are converted
+        to float16 in place (except for their STFT windows).
+        """
+
+        super(Separator, self).__init__()
+
+        # keeps the order of the targets along the last output dimension,
+        # pass an `OrderedDict` or a list of (name, model) pairs since plain
+        # dicts are unordered before python 3.7
+        # (`nn.ModuleDict` would sort the keys of a plain dict)
+        self.target_models = nn.ModuleDict(OrderedDict(target_models))
+
+        # all targets share the same STFT and spectrogram settings,
+        # so the mixture is transformed only once by the separator itself
+        first_target = next(iter(self.target_models.values()))
+        self.stft = STFT(
+            n_fft=first_target.stft.n_fft,
+            n_hop=first_target.stft.n_hop,
+            center=first_target.stft.center,
+            use_conv=first_target.stft.use_conv
+        )
+        self.stft.window = first_target.stft.window
+        self.spec = Spectrogram(
+            power=first_target.spec.power,
+            mono=first_target.spec.mono
+        )
+
+        # optionally run the target models in float16 (cuda only), while
+        # the STFT and spectrogram above stay in float32
+        self.half_precision = half
+        if half:
+            for unmix_target in self.target_models.values():
+                unmix_target.half()
+                # the network only runs on spectrograms, keep its STFT
+                # (shared with `transform`) in float32
+                unmix_target.stft.float()
+
+        # stacked dense layers for inference, see `_stacked_linears`
+        self._stacked = None
+
+    def train(self, mode=True):
+        # parameters may change during training, restack them afterwards
+        self._stacked = None
+        return super(Separator, self).train(mode)
+
+    def _apply(self, fn):
+        # `to`, `cuda`, `half`, ... also have to move the stacked layers
+        self._stacked = None
+        return super(Separator, self)._apply(fn)
+
+    def _can_stack(self):
+        """
+        The dense layers of all targets can be evaluated jointly at
+        inference, if all targets share the same layer sizes and use
+        (non-quantized) linear layers
+        """
+        if self.training:
+            return False
+
+        models = list(self.target_models.values())
+        sizes = (
+            models[0].nb_bins, models[0].nb_output_bins,
+            models[0].hidden_size, models[0].fc1.in_features
+        )
+        for unmix_target in models:
+            for fc_name, bn_name in (
+                ('fc1', 'bn1'), ('fc2', 'bn2'), ('fc3', 'bn3')
+            ):
+                if not isinstance(getattr(unmix_target, fc_name), Linear):
+                    return False
+                if not isinstance(
+                    getattr(unmix_target, bn_name), (BatchNorm1d, NoOp)
+                ):
+                    return False
+            if sizes != (
+                unmix_target.nb_bins, unmix_target.nb_output_bins,
+                unmix_target.hidden_size, unmix_target.fc1.in_features
+            ):
+                return False
+        return True
+
+    def _stacked_linears(self):
+        """
+        Stacks the dense layers of all targets with input normalization and
+        batch norm folded in. fc1 is concatenated along the output dimension
+        (all targets share the same input), fc2/fc3 are stacked for `bmm`.
+        The folding is done in float32 and the results are cast to the
+        dtype of the target models once.
+
+        The stacked layers are cached until the separator is moved or put
+        into `train`/`eval` mode again, call `eval()` after modifying the
+        target models (e.g. `fuse_bn`).
+        """
+        if self._stacked is not None:
+            return self._stacked
+
+        w1, b1, w2, b2, w3, b3 = [], [], [], [], [], []
+        for unmix_target in self.target_models.values():
+            fc1 = unmix_target.fc1
+            nb_channels = fc1.in_features // unmix_target.nb_bins
+
+            # (x + mean) * scale -> fc1 equals x -> fc1 with scaled weights
+            # and the shifted mean as bias
+            input_scale = unmix_target.input_scale.float()
+            scale = input_scale.repeat(nb_channels)
+            shift = (
+                unmix_target.input_mean.float() * input_scale
+            ).repeat(nb_channels)
+            weight = fc1.weight.float() * scale
+            bias = torch.mv(fc1.weight.float(), shift)
+            if fc1.bias is not None:
+                bias = bias + fc1.bias.float()
+            weight, bias = _fold_bn(weight, bias, unmix_target.bn1)
+            w1.append(weight)
+            b1.append(bias)
+
+            weight, bias = _fold_bn(
+                unmix_target.fc2.weight.float(), unmix_target.fc2.bias,
+                unmix_target.bn2
+            )
+            w2.append(weight.t())
+            b2.append(bias)
+
+            weight, bias = _fold_bn(
+                unmix_target.fc3.weight.float(), unmix_target.fc3.bias,
+                unmix_target.bn3
+            )
+            w3.append(weight.t())
+            b3.append(bias)
+
+        dtype = fc1.weight.dtype
+        self._stacked = tuple(p.detach().to(dtype) for p in (
+            torch.cat(w1), torch.cat(b1),
+            torch.stack(w2), torch.stack(b2)[:, None],
+            torch.stack(w3), torch.stack(b3)[:, None]
+        ))
+        return self._stacked
+
+    def _forward_stacked(self, mix_spec):
+        """
+        Input: Power/Mag Spectrogram
+                (nb_frames, nb_samples, nb_channels, nb_bins)
+        Output: (nb_frames, nb_samples, nb_channels, nb_bins, nb_targets)
+        """
+        models = list(self.target_models.values())
+        nb_targets = len(models)
+        nb_frames = mix_spec.shape[0]
+        nb_samples = mix_spec.shape[1]
+        nb_channels = mix_spec.shape[2]
+        hidden_size = models[0].hidden_size
+
+        w1, b1, w2, b2, w3, b3 = self._stacked_linears()
+
+        # a single GEMM encodes the mixture for all targets at once
+        x = torch.addmm(
+            b1,
+            mix_spec[..., :models[0].nb_bins].reshape(-1, w1.shape[1]),
+            w1.t()
+        )
+        x = torch.tanh_(x).view(nb_frames, nb_samples, nb_targets, hidden_size)
+
+        # the LSTMs have different weights and are applied per target,
+        # followed by the skip connection
+        x = torch.stack([
+            torch.cat([x[:, :, j], unmix_target.lstm(x[:, :, j])[0]], -1)
+            for j, unmix_target in enumerate(models)
+        ])
+
+        # (nb_targets, nb_frames*nb_samples, *) batched dense stages
+        x = torch.baddbmm(b2, x.view(nb_targets, -1, 2 * hidden_size), w2)
+        x = F.relu(x, inplace=True)
+        x = torch.baddbmm(b3, x, w3)
+        x = x.view(nb_targets, nb_frames, nb_samples, nb_channels, -1)
+
+        # apply output scaling and the mixture as in `OpenUnmix`
+        output_mean = torch.stack([m.output_mean for m in models])
+        output_scale = torch.stack([m.output_scale for m in models])
+        x = torch.addcmul(
+            output_mean.view(nb_targets, 1, 1, 1, -1),
+            x,
+            output_scale.view(nb_targets, 1, 1, 1, -1)
+        )
+        x = F.relu(x, inplace=True) * mix_spec
+
+        return x.permute(1, 2, 3, 4, 0)
+
+    def forward(self, audio):
+        spectrograms = None
+        nb_targets = len(self.target_models)
+
+        mix_stft = self.stft(audio)
+        mix_spec = self.spec(mix_stft)
+        if self.half_precision:
+            mix_spec = mix_spec.half()
+
+        if self._can_stack():
+            # outputs are returned in float32 for the wiener filter
+            return self._forward_stacked(mix_spec).float(), mix_stft
+
+        for j, unmix_target in enumerate(self.target_models.values()):
+            # outputs are returned in float32 for the wiener filter
+            target_spectrogram = unmix_target._forward_from_spec(
+                mix_spec
+            ).float()
+            if spectrograms is None:
+                # allocate the stacked output once the shape is known
+                spectrograms = target_spectrogram.new_empty(
+                    target_spectrogram.shape + (nb_targets,)
+                )
+            spectrograms[..., j] = target_spectrogram
+
+        return spectrograms, mix_stft
@@ -4,42 +4,44 @@ import argparse
 import soundfile as sf
 import norbert
 import json
+import functools
+from collections import OrderedDict
 from pathlib import Path
-import scipy.signal
 import resampy
 import model
 import utils
+import hubconf
 import warnings
 import tqdm
-from contextlib import redirect_stderr
-import io
 
 
-def load_model(target, model_name='umxhq', device='cpu'):
+def load_model(target, model_name='umxhq', device='cpu', quantize=False):
     """
     target model path can be either <target>.pth, or <target>-sha256.pth
     (as used on torchub)
+
+    if `quantize` is set, the linear and lstm layers are dynamically
+    quantized to int8, which requires `device` to be cpu
     """
     model_path = Path(model_name).expanduser()
     if not model_path.exists():
         # model path does not exist, use hubconf model
         try:
-            # disable progress bar
-            err = io.StringIO()
-            with redirect_stderr(err):
-                return torch.hub.load(
-                    'sigsep/open-unmix-pytorch',
-                    model_name,
-                    target=target,
-                    device=device,
-                    pretrained=True
-                )
-            print(err.getvalue())
+            # use the local hubconf entry points so that the weights
+            # are loaded into the `model.OpenUnmix` of this tree
+            entry_point = getattr(hubconf, model_name)
         except AttributeError:
             raise NameError('Model does not exist on torchhub')
-            # assume model is a path to a local model_name direcotry
+
+        unmix = entry_point(
+            target=target,
+            device=device,
+            pretrained=True,
+            progress=False
+        )
     else:
-        # load model from disk
+        # assume model is a path to a local model_name directory
+        # and load model from disk
         with open(Path(model_path, target + '.json'), 'r') as stream:
             results = json.load(stream)
 
@@ -67,18 +69,34 @@ def load_model(target, model_name='umxhq', device='cpu'):
         unmix.stft.center = True
         unmix.eval()
         unmix.to(device)
-        return unmix
+
+    # batch norm statistics are frozen at inference
+    unmix.fuse_bn()
+
+    if quantize:
+        unmix = torch.quantization.quantize_dynamic(
+            unmix, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8
+        )
+    return unmix
+
+
+@functools.lru_cache()
+def _inverse_stft(n_fft, n_hopsize):
+    # one instance per setting, so that its window envelope is reused
+    return model.ISTFT(n_fft=n_fft, n_hop=n_hopsize, center=True)
 
 
 def istft(X, rate=44100, n_fft=4096, n_hopsize=1024):
-    t, audio = scipy.signal.istft(
-        X / (n_fft / 2),
-        rate,
-        nperseg=n_fft,
-        noverlap=n_fft - n_hopsize,
-        boundary=True
-    )
-    return audio
+    """
+    inverse of the centered `model.STFT` for complex numpy spectrograms of
+    shape (..., nb_bins, nb_frames), computed in a single batched call.
+    `rate` is unused and only kept for backwards compatibility.
+    """
+    # interleaved complex64 has the same memory layout as a trailing
+    # (real, imag) dimension, so this is a single copy and a view
+    X = np.ascontiguousarray(X, dtype=np.complex64)
+    X = torch.from_numpy(X.view(np.float32).reshape(X.shape + (2,)))
+    return _inverse_stft(n_fft, n_hopsize)(X).numpy()
 
 
 def separate(
@@ -86,7 +104,7 @@ def separate(
     targets,
     model_name='umxhq',
     niter=1, softmask=False, alpha=1.0,
-    residual_model=False, device='cpu'
+    residual_model=False, device='cpu', quantize=False, half=False
 ):
     """
     Performing the separation on audio input
@@ -124,37 +142,57 @@ def separate(
     device: str
         set torch device. Defaults to `cpu`.
 
+    quantize: boolean
+        dynamically quantize the linear and lstm layers to int8 for faster
+        cpu inference, defaults to False
+
+    half: boolean
+        run the models in float16 on cuda devices, the STFT and the
+        wiener filter stay in full precision, defaults to False
+
     Returns
     -------
     estimates: `dict` [`str`, `np.ndarray`]
         dictionary of all restimates as performed by the separation model.
 
     """
+    if quantize and torch.device(device).type != 'cpu':
+        raise ValueError('Quantized models only run on cpu')
+
+    if half and torch.device(device).type != 'cuda':
+        raise ValueError('Half precision is only supported on cuda')
+
     # convert numpy audio to torch
     audio_torch = torch.tensor(audio.T[None, ...]).float().to(device)
 
-    source_names = []
-    V = []
-
-    for j, target in enumerate(tqdm.tqdm(targets)):
-        unmix_target = load_model(
+    # an ordered mapping keeps the targets in the given order
+    separator = model.Separator(OrderedDict(
+        (target, load_model(
             target=target,
             model_name=model_name,
-            device=device
-        )
-        Vj = unmix_target(audio_torch).cpu().detach().numpy()
-        if softmask:
-            # only exponentiate the model if we use softmask
-            Vj = Vj**alpha
-        # output is nb_frames, nb_samples, nb_channels, nb_bins
-        V.append(Vj[:, 0, ...])  # remove sample dim
-        source_names += [target]
-
-    V = np.transpose(np.array(V), (1, 3, 2, 0))
-
-    X = unmix_target.stft(audio_torch).detach().cpu().numpy()
-    # convert to complex numpy type
-    X = X[..., 0] + X[..., 1]*1j
+            device=device,
+            quantize=quantize
+        ))
+        for target in tqdm.tqdm(targets)
+    ), half=half)
+
+    # no autograd graph is needed at inference
+    with torch.no_grad():
+        # output is nb_frames, nb_samples, nb_channels, nb_bins, nb_targets
+        V, X = separator(audio_torch)
+    V = V[:, 0].cpu().numpy()  # remove sample dim
+    # to (nb_frames, nb_bins, nb_channels, nb_targets)
+    V = V.transpose(0, 2, 1, 3)
+    # names in the order of the last output dimension
+    source_names = list(separator.target_models.keys())
+
+    if softmask:
+        # only exponentiate the model if we use softmask
+        V **= alpha
+
+    X = X.cpu().numpy()
+    # view the trailing (real, imag) dimension as complex numpy type
+    X = X.view(np.complex64)[..., 0]
     X = X[0].transpose(2, 1, 0)
 
     if residual_model or len(targets) == 1:
@@ -165,14 +203,16 @@ def separate(
     Y = norbert.wiener(V, X.astype(np.complex128), niter,
                        use_softmask=softmask)
 
+    # invert all sources at once to (nb_sources, nb_channels, nb_timesteps)
+    audio_hat = istft(
+        Y.T,
+        n_fft=separator.stft.n_fft,
+        n_hopsize=separator.stft.n_hop
+    )
+
     estimates = {}
     for j, name in enumerate(source_names):
-        audio_hat = istft(
-            Y[..., j].T,
-            n_fft=unmix_target.stft.n_fft,
-            n_hopsize=unmix_target.stft.n_hop
-        )
-        estimates[name] = audio_hat.T
+        estimates[name] = audio_hat[j].T
 
     return estimates
 
@@ -219,6 +259,18 @@ def inference_args(parser, remaining_args):
         action='store_true',
         help='create a model for the residual'
     )
+
+    inf_parser.add_argument(
+        '--quantize',
+        action='store_true',
+        help='quantize the models to int8 for faster cpu inference'
+    )
+
+    inf_parser.add_argument(
+        '--half',
+        action='store_true',
+        help='run the models in float16 for faster gpu inference'
+    )
     return inf_parser.parse_args()
 
 
@@ -226,11 +278,16 @@ def test_main(
     input_files=None, samplerate=44100, niter=1, alpha=1.0,
     softmask=False, residual_model=False, model='umxhq',
     targets=('vocals', 'drums', 'bass', 'other'),
-    outdir=None, start=0.0, duration=-1.0, no_cuda=False
+    outdir=None, start=0.0, duration=-1.0, no_cuda=False, quantize=False,
+    half=False
 ):
 
-    use_cuda = not no_cuda and torch.cuda.is_available()
+    # quantized models only run on cpu
+    use_cuda = not no_cuda and not quantize and torch.cuda.is_available()
     device = torch.device("cuda" if use_cuda else "cpu")
+    if use_cuda:
+        # let cudnn pick the fastest (lstm) kernels for the input sizes
+        torch.backends.cudnn.benchmark = True
 
     for input_file in input_files:
         # handling an input audio path
@@ -274,7 +331,9 @@ def test_main(
             alpha=alpha,
             softmask=softmask,
             residual_model=residual_model,
-            device=device
+            device=device,
+            quantize=quantize,
+            half=half
         )
         if not outdir:
             model_path = Path(model)
@@ -365,5 +424,6 @@ if __name__ == '__main__':
         alpha=args.alpha, softmask=args.softmask, niter=args.niter,
         residual_model=args.residual_model, model=args.model,
         targets=args.targets, outdir=args.outdir, start=args.start,
-        duration=args.duration, no_cuda=args.no_cuda
+        duration=args.duration, no_cuda=args.no_cuda,
+        quantize=args.quantize, half=args.half
     )
@@ -1,5 +1,8 @@
+from collections import OrderedDict
+import copy
 import pytest
 import model
+import utils
 import torch
 
 
@@ -71,3 +74,205 @@ def test_shape(
     X = spec(audio)
     Y = unmix(X)
     assert X.shape == Y.shape
+
+
+def test_stft_window_is_buffer():
+    unmix = model.OpenUnmix()
+    assert 'stft.window' in dict(unmix.named_buffers())
+    assert 'stft.window' not in dict(unmix.named_parameters())
+    # pretrained state dicts keep loading under the same key
+    assert 'stft.window' in unmix.state_dict()
+
+
+def test_spectrogram_input_is_not_modified():
+    unmix = model.OpenUnmix(input_is_spectrogram=True, nb_channels=1)
+    unmix.eval()
+    X = torch.rand((4, 1, 1, unmix.nb_output_bins))
+    X_ref = X.clone()
+    unmix(X)
+    assert torch.equal(X, X_ref)
+
+
+def test_separator_shape(audio, nb_channels):
+    targets = ['vocals', 'drums', 'bass']
+    separator = model.Separator(OrderedDict(
+        (target, model.OpenUnmix(
+            nb_channels=nb_channels, hidden_size=32, nb_layers=1
+        ))
+        for target in targets
+    ))
+    separator.eval()
+    assert list(separator.target_models.keys()) == targets
+
+    unmix = separator.target_models['vocals']
+    X = torch.nn.Sequential(unmix.stft, unmix.spec)(audio)
+    Y, mix_stft = separator(audio)
+    assert Y.shape == X.shape + (len(targets),)
+    assert torch.equal(mix_stft, unmix.stft(audio))
+
+
+@pytest.mark.parametrize('power', [1, 2, 3])
+def test_spectrogram_power(audio, power):
+    stft_f = model.STFT(n_fft=1024, n_hop=512)(audio)
+    spec = model.Spectrogram(power=power, mono=False)(stft_f)
+    expected = stft_f.pow(2).sum(-1).pow(power / 2.0).permute(3, 0, 1, 2)
+    assert torch.allclose(spec, expected, rtol=1e-4, atol=1e-5)
+    # flattening to (nb_frames*nb_samples, nb_channels*nb_bins) is a view
+    assert spec.is_contiguous()
+
+
+def test_fuse_bn(audio, nb_channels):
+    unmix = model.OpenUnmix(
+        n_fft=1024, n_hop=512, nb_channels=nb_channels, hidden_size=32
+    )
+    # non-trivial running statistics and affine parameters
+    for bn in (unmix.bn1, unmix.bn2, unmix.bn3):
+        bn.running_mean.uniform_(-1, 1)
+        bn.running_var.uniform_(0.5, 2)
+        bn.weight.data.uniform_(0.5, 2)
+        bn.bias.data.uniform_(-1, 1)
+    unmix.eval()
+
+    with torch.no_grad():
+        Y = unmix(audio)
+        unmix.fuse_bn()
+        Y_fused = unmix(audio)
+
+    assert isinstance(unmix.bn1, model.NoOp)
+    assert torch.allclose(Y, Y_fused, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('center', [True, False])
+def test_conv_stft(audio, center):
+    stft = model.STFT(n_fft=1024, n_hop=256, center=center)
+    X = stft(audio)
+    stft.use_conv = True
+    X_conv = stft(audio)
+    assert X.shape == X_conv.shape
+    assert torch.allclose(X, X_conv, rtol=1e-4, atol=1e-3)
+
+
+def test_backward(audio, nb_channels):
+    # in-place activations must not break autograd in training mode
+    unmix = model.OpenUnmix(
+        n_fft=1024, n_hop=512, nb_channels=nb_channels, hidden_size=32
+    )
+    unmix.train()
+    unmix(audio).mean().backward()
+    assert unmix.fc1.weight.grad is not None
+
+
+@pytest.mark.parametrize('fuse_bn', [True, False])
+def test_separator_stacked(audio, nb_channels, fuse_bn):
+    targets = ['vocals', 'drums']
+    target_models = OrderedDict()
+    for target in targets:
+        unmix = model.OpenUnmix(
+            n_fft=1024, n_hop=512, nb_channels=nb_channels, hidden_size=32,
+            max_bin=400
+        )
+        for bn in (unmix.bn1, unmix.bn2, unmix.bn3):
+            bn.running_mean.uniform_(-1, 1)
+            bn.running_var.uniform_(0.5, 2)
+        for param in (
+            unmix.input_mean, unmix.input_scale,
+            unmix.output_mean, unmix.output_scale
+        ):
+            param.data.uniform_(0.5, 2)
+        unmix.eval()
+        if fuse_bn:
+            unmix.fuse_bn()
+        target_models[target] = unmix
+
+    separator = model.Separator(target_models)
+    separator.eval()
+    assert separator._can_stack()
+
+    with torch.no_grad():
+        Y, _ = separator(audio)
+        for j, target in enumerate(targets):
+            Y_target = target_models[target](audio)
+            assert torch.allclose(Y[..., j], Y_target, rtol=1e-4, atol=1e-3)
+
+    # the stacked layers are reused until the separator is modified
+    stacked = separator._stacked_linears()
+    assert separator._stacked_linears() is stacked
+    separator.double()
+    assert separator._stacked_linears()[0].dtype == torch.float64
+
+
+@pytest.mark.skipif(
+    not torch.cuda.is_available(), reason='half precision requires cuda'
+)
+def test_separator_half(audio, nb_channels):
+    targets = ['vocals', 'drums']
+    target_models = OrderedDict()
+    for target in targets:
+        unmix = model.OpenUnmix(
+            n_fft=1024, n_hop=512, nb_channels=nb_channels, hidden_size=32
+        )
+        for bn in (unmix.bn1, unmix.bn2, unmix.bn3):
+            bn.running_mean.uniform_(-1, 1)
+            bn.running_var.uniform_(0.5, 2)
+        unmix.eval()
+        target_models[target] = unmix.cuda()
+
+    separator = model.Separator(copy.deepcopy(target_models))
+    separator_half = model.Separator(copy.deepcopy(target_models), half=True)
+    separator.eval()
+    separator_half.eval()
+
+    audio = audio.cuda()
+    with torch.no_grad():
+        Y, _ = separator(audio)
+        Y_half, _ = separator_half(audio)
+
+    assert Y_half.dtype == torch.float32
+    assert torch.allclose(Y_half, Y, rtol=1e-2, atol=1e-2)
+
+
+def test_separator_quantized(audio, nb_channels):
+    unmix = model.OpenUnmix(
+        n_fft=1024, n_hop=512, nb_channels=nb_channels, hidden_size=32
+    )
+    unmix.eval()
+    unmix.fuse_bn()
+    unmix_quantized = torch.quantization.quantize_dynamic(
+        copy.deepcopy(unmix), {torch.nn.Linear, torch.nn.LSTM},
+        dtype=torch.qint8
+    )
+
+    separator = model.Separator(OrderedDict([('vocals', unmix_quantized)]))
+    separator.eval()
+    # quantized layers can not be stacked, fall back to the per target loop
+    assert not separator._can_stack()
+
+    with torch.no_grad():
+        Y, _ = separator(audio)
+        Y_float = unmix(audio)
+
+    assert Y.shape == Y_float.shape + (1,)
+    error = (Y[..., 0] - Y_float).abs().mean()
+    assert error < 0.1 * Y_float.abs().mean()
+
+
+def test_resume_optimizer_with_stft_window_parameter():
+    unmix = model.OpenUnmix(n_fft=1024, n_hop=512, hidden_size=32)
+    named = list(unmix.named_parameters())
+    own = [p for name, p in named if '.' not in name]
+    submodules = [p for name, p in named if '.' in name]
+    # parameter order of checkpoints with the window as frozen parameter
+    window = torch.nn.Parameter(unmix.stft.window, requires_grad=False)
+    legacy_optimizer = torch.optim.Adam(own + [window] + submodules)
+
+    unmix(torch.rand((1, 2, 4096))).mean().backward()
+    legacy_optimizer.step()
+
+    optimizer = torch.optim.Adam(unmix.parameters())
+    optimizer.load_state_dict(
+        utils.drop_stft_window_state(legacy_optimizer.state_dict(), unmix)
+    )
+    for p in unmix.parameters():
+        assert torch.equal(
+            optimizer.state[p]['exp_avg'], legacy_optimizer.state[p]['exp_avg']
+        )
@@ -215,7 +215,9 @@ def main():
         target_model_path = Path(model_path, args.target + ".chkpnt")
         checkpoint = torch.load(target_model_path, map_location=device)
         unmix.load_state_dict(checkpoint['state_dict'])
-        optimizer.load_state_dict(checkpoint['optimizer'])
+        optimizer.load_state_dict(
+            utils.drop_stft_window_state(checkpoint['optimizer'], unmix)
+        )
         scheduler.load_state_dict(checkpoint['scheduler'])
         # train for another epochs_trained
         t = tqdm.trange(
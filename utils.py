@@ -133,6 +133,27 @@ def save_checkpoint(
         )
 
 
+def drop_stft_window_state(optimizer_state, unmix):
+    """
+    Optimizer states saved while the STFT window was a (frozen) parameter
+    of `unmix` list one parameter more than `unmix.parameters()` does now.
+    The window is dropped so that old checkpoints can be resumed.
+    """
+    params = optimizer_state['param_groups'][0]['params']
+    if len(params) != len(list(unmix.parameters())) + 1:
+        return optimizer_state
+
+    # the window followed the own parameters of the model, as the stft is
+    # its first submodule
+    window_index = sum(
+        1 for name, _ in unmix.named_parameters() if '.' not in name
+    )
+    window_id = params.pop(window_index)
+    # the window never had a gradient and therefore no state, anyways
+    optimizer_state['state'].pop(window_id, None)
+    return optimizer_state
+
+
 class AverageMeter(object):
     """Computes and stores the average and current value"""
     def __init__(self):